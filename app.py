@@ -1,16 +1,46 @@
+import atexit
+import concurrent.futures
+import logging
+import logging.handlers
 import os
+import queue
 import re
 import socket
 import sys
+import threading
+from typing import Annotated, List, Optional
+import msgspec
+import orjson
+from cachetools import TTLCache
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
 from mcrcon import MCRcon
 
 # Load environment variables
 load_dotenv()
 
+class OrjsonProvider(JSONProvider):
+    """Routes jsonify and request.json through orjson instead of stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand the encoded bytes straight to the response, no str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev_key")
+app.json = OrjsonProvider(app)
+# A whitelist request body is just a username; refuse anything bigger before parsing
+app.config['MAX_CONTENT_LENGTH'] = 256
 
 # Configuration
 RCON_HOST = os.getenv("RCON_HOST", "127.0.0.1")
@@ -23,70 +53,281 @@ except ValueError:
 
 RCON_PASS = os.getenv("RCON_PASSWORD")
 BEDROCK_PREFIX = os.getenv("BEDROCK_PREFIX", ".")
+MAX_USERNAME_LENGTH = 24
+# Shared limiter storage so all gunicorn workers count the same requests
+RATELIMIT_STORAGE_URI = os.getenv("RATELIMIT_STORAGE_URI", "memory://")
+RCON_KEEPALIVE = 30  # seconds between pings on idle RCON connections
+RCON_POOL_SIZE = 4  # max idle RCON connections kept per process
+RCON_THREADS = 64  # max RCON attempts/broadcasts in flight per process
 
-def debug_log(message):
-    """Prints to console immediately"""
-    print(f"[DEBUG] {message}", file=sys.stdout)
-    sys.stdout.flush()
-
-def sanitize_username(username):
-    """Strictly validate username."""
-    # Allow dot (.) for Bedrock prefixes, spaces for Xbox, and underscores
-    safe_name = re.sub(r'[^a-zA-Z0-9_ \.]', '', username)
-    return safe_name.strip()
-
-def check_port_open(host, port):
-    """Checks if a TCP port is open before trying RCON"""
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(2) # 2 second timeout
-    result = sock.connect_ex((host, port))
-    sock.close()
-    return result == 0
+# Turn away floods at the HTTP layer before they cost an RCON connection
+limiter = Limiter(get_remote_address, app=app, storage_uri=RATELIMIT_STORAGE_URI)
 
-def send_rcon_command(username):
+# Request threads only enqueue log records; a background listener does the stdout writes
+log = logging.getLogger("whitelist")
+log.setLevel(logging.DEBUG)
+log.propagate = False
+_log_queue = queue.Queue(-1)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+class WhitelistRequest(msgspec.Struct):
+    """Body of POST /api/whitelist, validated in a single decode pass."""
+    # Letters, digits and underscores, dot (.) for Bedrock prefixes, spaces for Xbox.
+    # Real names are at most 16 chars (plus a Bedrock prefix).
+    username: Optional[Annotated[str, msgspec.Meta(max_length=MAX_USERNAME_LENGTH,
+                                                   pattern=r'^[A-Za-z0-9_ .]*$')]] = None
+
+class TimeoutRcon(MCRcon):
+    """MCRcon that fails fast when the RCON port is closed or filtered."""
+
+    def __init__(self, host, password, port=25575, timeout=5, addr=None, read_timeout=5):
+        # Skip MCRcon's SIGALRM handler: it can only be installed from the
+        # main thread, and the socket timeouts below do the same job
+        self.host = host
+        self.password = password
+        self.port = port
+        self.tlsmode = 0
+        # timeout bounds the TCP connect only; replies get MCRcon's usual 5s,
+        # since 'whitelist add' may wait on a Mojang profile lookup
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        # Pre-resolved sockaddr, saves a getaddrinfo per connect
+        self.addr = addr or (host, port)
+
+    def connect(self):
+        self.open_socket()
+        self.login()
+
+    def open_socket(self):
+        """TCP connect only. Stock MCRcon connects with no timeout at all."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # RCON packets are tiny request/response pairs, don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.addr)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(self.read_timeout)
+        self.socket = sock
+
+    def login(self):
+        self._send(3, self.password)
+
+    def _read(self, length):
+        data = b""
+        while len(data) < length:
+            chunk = self.socket.recv(length - len(data))
+            if not chunk:
+                # Server closed the connection (restart, idle kick, ...)
+                raise ConnectionResetError("RCON connection closed by server")
+            data += chunk
+        return data
+
+def _resolve_rcon_addr():
+    """Resolves RCON_HOST to a sockaddr. None means resolve on each connect."""
+    try:
+        return socket.getaddrinfo(RCON_HOST, RCON_PORT, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+    except socket.gaierror as e:
+        log.warning(f"Could not resolve RCON_HOST {RCON_HOST}: {e}")
+        return None
+
+_RCON_ADDR = _resolve_rcon_addr()
+
+# Logged-in RCON connections not currently in use, guarded by _rcon_lock
+_rcon_lock = threading.Lock()
+_idle_rcons: List[TimeoutRcon] = []
+
+# Runs the Java and Bedrock whitelist attempts side by side. Under gunicorn's
+# gevent workers threading and socket are monkey-patched, so these "threads"
+# are greenlets and every RCON recv yields to the worker's event loop.
+# Sized apart from the idle pool: each signup needs up to three tasks, and a
+# slow RCON server must not make a worker's other signups queue behind it.
+_pool = concurrent.futures.ThreadPoolExecutor(max_workers=RCON_THREADS)
+
+def _connect_rcon():
     """
-    Connects to Minecraft RCON and executes the whitelist command.
+    Opens and logs in a new RCON connection. If the TCP connect is refused or
+    times out and RCON_HOST now resolves elsewhere, it is retried once there.
     """
-    debug_log(f"Starting RCON connection to {RCON_HOST}:{RCON_PORT}")
+    global _RCON_ADDR
+    log.debug(f"Opening RCON connection to {RCON_HOST}:{RCON_PORT}")
+    mcr = TimeoutRcon(RCON_HOST, RCON_PASS, port=RCON_PORT, timeout=2, addr=_RCON_ADDR)
+    try:
+        mcr.open_socket()
+    except (ConnectionRefusedError, socket.timeout) as e:
+        # The host may have a new IP, e.g. after its container restarted
+        addr = _resolve_rcon_addr()
+        if addr is None or addr == _RCON_ADDR:
+            raise
+        log.debug(f"RCON connect to {_RCON_ADDR} failed ({e}), {RCON_HOST} now resolves to {addr}")
+        _RCON_ADDR = addr
+        mcr = TimeoutRcon(RCON_HOST, RCON_PASS, port=RCON_PORT, timeout=2, addr=addr)
+        mcr.open_socket()
+    try:
+        mcr.login()
+    except Exception:
+        mcr.disconnect()
+        raise
+    return mcr
 
-    # 1. PRE-CHECK: Is the port even open?
-    if not check_port_open(RCON_HOST, RCON_PORT):
-        msg = f"Port {RCON_PORT} on {RCON_HOST} is CLOSED or blocked."
-        debug_log(f"FAILURE: {msg}")
-        debug_log("TIP: Check server.properties. Is 'enable-rcon=true'? Is 'rcon.port' correct? Did you restart the server?")
-        return False, "Server is not listening on the RCON port. Ask admin to check server.properties."
+def _reserve_rcon():
+    """Takes an idle connection from the pool, or opens a new one."""
+    with _rcon_lock:
+        if _idle_rcons:
+            return _idle_rcons.pop()
+    return _connect_rcon()
+
+def _release_rcon(mcr):
+    """Hands a healthy connection back to the pool."""
+    with _rcon_lock:
+        if len(_idle_rcons) < RCON_POOL_SIZE:
+            _idle_rcons.append(mcr)
+            return
+    mcr.disconnect()
+
+def rcon_commands(*commands):
+    """
+    Runs commands on a pooled RCON connection and returns their responses.
+    A connection the server has dropped is replaced once before giving up.
+    """
+    for attempt in range(2):
+        mcr = _reserve_rcon() if not attempt else _connect_rcon()
+        try:
+            responses = [mcr.command(command) for command in commands]
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+            mcr.disconnect()
+            if attempt:
+                raise
+            log.debug(f"RCON connection lost ({e}), reconnecting")
+            continue
+        except Exception:
+            # Unknown protocol state, don't put it back
+            mcr.disconnect()
+            raise
+        _release_rcon(mcr)
+        return responses
+
+def _rcon_keepalive():
+    """Pings the idle RCON connections so they stay warm, then reschedules itself."""
+    with _rcon_lock:
+        idle = _idle_rcons[:]
+        _idle_rcons.clear()
+    for mcr in idle:
+        try:
+            mcr.command('list')
+        except Exception as e:
+            log.debug(f"RCON keepalive failed: {e}")
+            mcr.disconnect()
+            continue
+        _release_rcon(mcr)
+    _schedule_rcon_keepalive()
+
+def _schedule_rcon_keepalive():
+    timer = threading.Timer(RCON_KEEPALIVE, _rcon_keepalive)
+    timer.daemon = True
+    timer.start()
+
+_schedule_rcon_keepalive()
+
+# Known outcomes of 'whitelist add', mapped to user-facing messages
+_RESPONSE_RE = re.compile(r"Added|already|does not exist")
+
+_JAVA_MESSAGES = {
+    "Added": "Success! {u} added to the whitelist.",
+    "already": "{u} is already whitelisted.",
+    "does not exist": "Java username '{u}' not found. Check spelling.",
+    None: "Java attempt response: {jmsg}",
+}
+
+_BEDROCK_MESSAGES = {
+    "Added": "Success! {b} (Bedrock) added to the whitelist.",
+    "already": "{b} (Bedrock) is already whitelisted.",
+    "does not exist": "Bedrock username '{b}' not found. Ensure Floodgate is installed and username is correct.",
+    None: "Bedrock attempt response: {bmsg}",
+}
+
+def _build_message_table():
+    """
+    Precomputes the final message template for every combination of
+    (java_success, bedrock_success, java_outcome, bedrock_outcome).
+    A failed attempt's outcome is "failed"; a Bedrock attempt that was
+    never made is "".
+    """
+    java = [(True, key, text) for key, text in _JAVA_MESSAGES.items()]
+    java.append((False, "failed", "Java attempt failed: {jmsg}"))
+    bedrock = [(True, key, text) for key, text in _BEDROCK_MESSAGES.items()]
+    bedrock.append((False, "failed", "Bedrock attempt failed: {bmsg}"))
+    bedrock.append((False, "", None))
 
+    found = ("Added", "already")
+    table = {}
+    for java_ok, java_key, java_text in java:
+        for bedrock_ok, bedrock_key, bedrock_text in bedrock:
+            if java_ok or bedrock_ok:
+                # Any success hides the other attempt's failure
+                parts = [java_text if java_ok else None, bedrock_text if bedrock_ok else None]
+                # Once one platform knows the name, "not found" on the other is just noise
+                if java_ok and java_key in found and bedrock_key == "does not exist":
+                    parts[1] = None
+                if bedrock_ok and bedrock_key in found and java_key == "does not exist":
+                    parts[0] = None
+            else:
+                parts = [java_text, bedrock_text]
+            table[java_ok, bedrock_ok, java_key, bedrock_key] = " ".join(p for p in parts if p)
+    return table
+
+_MSG_TABLE = _build_message_table()
+
+def classify_response(msg):
+    """Returns the known outcome an RCON response reports, or None."""
+    match = _RESPONSE_RE.search(msg)
+    return match.group() if match else None
+
+def _outcome(success, msg):
+    """Message table key for one whitelist attempt."""
+    if success:
+        return classify_response(msg)
+    return "failed" if msg else ""
+
+# Recent successful responses by username, so double-clicked submits skip RCON
+_recent = TTLCache(maxsize=1024, ttl=60)
+_recent_lock = threading.Lock()
+
+def send_rcon_command(username):
+    """
+    Executes the whitelist command over a pooled RCON connection.
+    """
     try:
-        # 2. ATTEMPT RCON CONNECTION
         # We use quotes around username for Xbox names with spaces
+        # Bedrock names are covered by whitelist_user's prefixed attempt
         command = f'whitelist add {username}'
-        command2 = f'whitelist add .{username}'  # For Bedrock with prefix
-        print(command)
-    
+        log.debug(f"Attempting RCON Login/Command: {command}")
         
-        debug_log(f"Port is open. Attempting RCON Login/Command: {command}")
-        
-        with MCRcon(RCON_HOST, RCON_PASS, port=RCON_PORT) as mcr:
-            # Broadcast the new signup to everyone online
-            mcr.command(f'say {username} has signed up for the server!')
-
-            response = mcr.command(command)
-            debug_log(f"RCON Response 1: {response}")
-            response2 = mcr.command(command2)
-            debug_log(f"RCON Response 2: {response2}")
-            
-            # Force save
-            mcr.command('whitelist reload')
-            
-            return True, response
+        # 'whitelist add' writes whitelist.json itself, so no reload round-trip
+        response, = rcon_commands(command)
+        log.debug(f"RCON Response: {response}")
+
+        return True, response
+
+    except socket.timeout:
+        log.debug("FAILURE: Connection timed out.")
+        return False, "Connection timed out."
 
     except ConnectionRefusedError:
-        debug_log("FAILURE: Connection Refused by remote host.")
-        return False, "Connection Refused. Server running?"
+        log.debug(f"FAILURE: Port {RCON_PORT} on {RCON_HOST} refused the connection.")
+        log.debug("TIP: Check server.properties. Is 'enable-rcon=true'? Is 'rcon.port' correct? Did you restart the server?")
+        return False, "Server is not listening on the RCON port. Ask admin to check server.properties."
         
     except Exception as e:
         error_str = str(e)
-        debug_log(f"FAILURE: Exception: {error_str}")
+        log.debug(f"FAILURE: Exception: {error_str}")
         
         if "Authentication failed" in error_str:
             return False, "RCON Authentication failed. Check password in .env"
@@ -95,90 +336,98 @@ def send_rcon_command(username):
              
         return False, f"RCON Error: {error_str}"
 
+def announce_signup(username):
+    """Broadcasts a new signup to everyone online. Best effort, errors are only logged."""
+    try:
+        rcon_commands(f'say {username} has signed up for the server!')
+    except Exception as e:
+        log.debug(f"Signup broadcast for {username} failed: {e}")
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"success": False, "message": "Request too large."}), 413
+
+@app.errorhandler(429)
+def rate_limited(e):
+    return jsonify({"success": False, "message": "Too many requests. Please wait a minute and try again."}), 429
+
 @app.route('/api/whitelist', methods=['POST'])
+@limiter.limit("5/minute;30/hour")
 def whitelist_user():
-    data = request.json
-    raw_username = data.get('username')
-    # platform = data.get('platform') # Get platform selection
-    
-    if not raw_username:
+    try:
+        req = msgspec.json.decode(request.get_data(), type=WhitelistRequest)
+    except msgspec.ValidationError as e:
+        # Only errors located at $.username are about the name itself
+        if "$.username" in str(e):
+            return jsonify({"success": False, "message": "Invalid username format"}), 400
+        return jsonify({"success": False, "message": "Invalid request"}), 400
+    except msgspec.DecodeError:
+        return jsonify({"success": False, "message": "Invalid request"}), 400
+
+    if not req.username:
         return jsonify({"success": False, "message": "Username required"}), 400
 
-    username = sanitize_username(raw_username)
+    username = req.username.strip()
     if not username:
         return jsonify({"success": False, "message": "Invalid username format"}), 400
 
+    with _recent_lock:
+        cached = _recent.get(username)
+    if cached is not None:
+        log.debug(f"Returning cached whitelist result for {username}")
+        return jsonify(cached)
+
     # --- New Whitelisting Logic ---
     # Attempt to whitelist as Java (or direct Bedrock if already prefixed)
-    java_success, java_response_msg = send_rcon_command(username)
-    debug_log(f"RCON Command Result (Java attempt): Success={java_success}, Message='{java_response_msg}'")
+    f_java = _pool.submit(send_rcon_command, username)
 
     bedrock_success = False
     bedrock_response_msg = ""
     bedrock_username = ""
 
-    # If the initial attempt failed and the username doesn't already start with the bedrock prefix,
-    # try whitelisting with the bedrock prefix.
-    if not java_success and not username.startswith(BEDROCK_PREFIX):
+    # If the username doesn't already start with the bedrock prefix, try the
+    # prefixed Bedrock name at the same time on a second connection.
+    f_bedrock = None
+    if not username.startswith(BEDROCK_PREFIX):
         bedrock_username = f"{BEDROCK_PREFIX}{username}"
-        bedrock_success, bedrock_response_msg = send_rcon_command(bedrock_username)
-        debug_log(f"RCON Command Result (Bedrock attempt): Success={bedrock_success}, Message='{bedrock_response_msg}'")
+        f_bedrock = _pool.submit(send_rcon_command, bedrock_username)
+
+    java_success, java_response_msg = f_java.result()
+    log.debug(f"RCON Command Result (Java attempt): Success={java_success}, Message='{java_response_msg}'")
+    if f_bedrock is not None:
+        bedrock_success, bedrock_response_msg = f_bedrock.result()
+        log.debug(f"RCON Command Result (Bedrock attempt): Success={bedrock_success}, Message='{bedrock_response_msg}'")
+
+    # Announce once, under whichever name was actually added; don't hold up the response
+    if _outcome(java_success, java_response_msg) == "Added":
+        _pool.submit(announce_signup, username)
+    elif _outcome(bedrock_success, bedrock_response_msg) == "Added":
+        _pool.submit(announce_signup, bedrock_username)
 
     # Combine results and determine final response
-    if java_success or bedrock_success:
-        final_success = True
-        messages = []
-        
-        # Process Java attempt response
-        if java_success:
-            if "Added" in java_response_msg:
-                messages.append(f"Success! {username} added to the whitelist.")
-            elif "already" in java_response_msg:
-                messages.append(f"{username} is already whitelisted.")
-            elif "does not exist" in java_response_msg:
-                messages.append(f"Java username '{username}' not found. Check spelling.")
-            else:
-                messages.append(f"Java attempt response: {java_response_msg}")
-        
-        # Process Bedrock attempt response
-        if bedrock_success:
-            if "Added" in bedrock_response_msg:
-                messages.append(f"Success! {bedrock_username} (Bedrock) added to the whitelist.")
-            elif "already" in bedrock_response_msg:
-                messages.append(f"{bedrock_username} (Bedrock) is already whitelisted.")
-            elif "does not exist" in bedrock_response_msg:
-                messages.append(f"Bedrock username '{bedrock_username}' not found. Ensure Floodgate is installed and username is correct.")
-            else:
-                messages.append(f"Bedrock attempt response: {bedrock_response_msg}")
-        
-        final_message = " ".join(messages) if messages else "Whitelist operation completed."
-        
-        return jsonify({
-            "success": final_success, 
-            "message": final_message
-        })
-    else:
+    key = (java_success, bedrock_success,
+           _outcome(java_success, java_response_msg),
+           _outcome(bedrock_success, bedrock_response_msg))
+    result = {
+        "success": java_success or bedrock_success,
+        "message": _MSG_TABLE[key].format(
+            u=username, b=bedrock_username,
+            jmsg=java_response_msg, bmsg=bedrock_response_msg),
+    }
+    if not result["success"]:
         # Both attempts failed
-        error_messages = []
-        if java_response_msg:
-            error_messages.append(f"Java attempt failed: {java_response_msg}")
-        if bedrock_response_msg:
-            error_messages.append(f"Bedrock attempt failed: {bedrock_response_msg}")
-        
-        # If no specific error messages, provide a generic one
-        if not error_messages:
-            error_messages.append("Failed to whitelist username. Please try again or contact support.")
+        return jsonify(result), 500
 
-        final_error_message = " ".join(error_messages)
-        
-        return jsonify({
-            "success": False, 
-            "message": final_error_message
-        }), 500
+    # Only cache once the server has confirmed the name. A timeout or refusal
+    # hidden behind the other attempt's "not found" must be retried for real
+    if "Added" in key[2:] or "already" in key[2:]:
+        with _recent_lock:
+            _recent[username] = result
+    return jsonify(result)
 
 if __name__ == '__main__':
     # Print initial config on startup
@@ -187,4 +436,11 @@ if __name__ == '__main__':
     if not RCON_PASS:
         print("WARNING: RCON_PASSWORD is empty in .env!")
     print("----------------------")
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    if os.getenv("FLASK_ENV") == "development":
+        app.run(host='0.0.0.0', port=5000, debug=True)
+    else:
+        # No reloader or debugger outside development. Production should use the
+        # Dockerfile's gunicorn command and never reach app.run at all.
+        print("Not in development mode. For production, serve with:")
+        print("  gunicorn -k gevent -w 4 --worker-connections 200 --bind 0.0.0.0:5000 app:app")
+        app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False, threaded=True)
\ No newline at end of file